@@ -1,26 +1,28 @@
 #!/usr/bin/env python
 
-import gc
 import os
 import sys
+import multiprocessing
 import numpy as np
 
 import json
-from numpyencoder import NumpyEncoder
 from pathlib import Path
 from argparse import ArgumentParser
 
 from astropy import units as u
 from astropy.table import Table, join
 from astropy.coordinates import SkyCoord
+from astropy.wcs import WCS
 
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import colors
 import matplotlib.pyplot as plt
 from matplotlib.patches import Ellipse
+from matplotlib.collections import EllipseCollection
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
+from scipy.spatial import cKDTree
 from shapely.geometry import Polygon
 
 import kvis_write_lib as kvis
@@ -28,134 +30,294 @@ import searchcats as sc
 import helpers
 import tqdm
 
-gc.enable()
+try:
+    import numba
+except ImportError:
+    numba = None
 
-class SourceEllipse:
-
-    def __init__(self, catalog_entry, column_dict):
-        self.RA  = catalog_entry[column_dict['ra']]
-        self.DEC = catalog_entry[column_dict['dec']]
-        self.Maj = catalog_entry[column_dict['majax']]
-        self.Min = catalog_entry[column_dict['minax']]
-        self.PA  = catalog_entry[column_dict['pa']]
+def match_ellipse_kernel(RA, DEC, Maj, Min, PA, ra_list, dec_list, maj_list, min_list, pa_list,
+                         FWHM_to_sigma_extent, search_dist, nsamples=90):
+    '''
+    Numeric part of match_source written as a loop over the candidates,
+    compiled with numba if it is available. Returns which candidates match
+    and which cross RA = 0 and still need to be checked with polygons.
+    '''
+    n = len(ra_list)
+    matched = np.zeros(n, dtype=np.bool_)
+    wrapped = np.zeros(n, dtype=np.bool_)
+
+    cos_dec = np.cos(np.radians(DEC))
+    a1 = FWHM_to_sigma_extent*Maj/2.
+    b1 = FWHM_to_sigma_extent*Min/2.
+    sin_pa1 = np.sin(np.radians(PA))
+    cos_pa1 = np.cos(np.radians(PA))
+    half_ra1  = np.sqrt((a1*sin_pa1)**2 + (b1*cos_pa1)**2)
+    half_dec1 = np.sqrt((a1*cos_pa1)**2 + (b1*sin_pa1)**2)
+
+    for j in range(n):
+        dlat = np.radians(dec_list[j] - DEC)
+        dlon = np.radians((ra_list[j] - RA + 180.) % 360. - 180.)
+        hav = np.sin(dlat/2.)**2 + cos_dec*np.cos(np.radians(dec_list[j]))*np.sin(dlon/2.)**2
+        separation = 2*np.arcsin(np.sqrt(min(max(hav, 0.), 1.)))
+        sky_separation = np.degrees(separation)
+        deprojection_factor = 1. + 0.5*separation**2
+
+        maj_match = sky_separation < FWHM_to_sigma_extent * deprojection_factor * (Maj/2. + maj_list[j]/2.) + search_dist
+        min_match = sky_separation <= FWHM_to_sigma_extent * (Min/2. + min_list[j]/2.)
+
+        if min_match or not maj_match:
+            matched[j] = min_match
+            continue
+
+        # Bounding boxes of the ellipses, see helpers.ellipse_bounding_box
+        dra  = np.degrees(dlon*cos_dec)
+        ddec = np.degrees(dlat)
+        a2 = (FWHM_to_sigma_extent*maj_list[j]+search_dist)/2.
+        b2 = (FWHM_to_sigma_extent*min_list[j]+search_dist)/2.
+        sin_pa2 = np.sin(np.radians(pa_list[j]))
+        cos_pa2 = np.cos(np.radians(pa_list[j]))
+        if abs(dra) > half_ra1 + np.sqrt((a2*sin_pa2)**2 + (b2*cos_pa2)**2):
+            continue
+        if abs(ddec) > half_dec1 + np.sqrt((a2*cos_pa2)**2 + (b2*sin_pa2)**2):
+            continue
+
+        if abs(ra_list[j] - RA) > 300:
+            wrapped[j] = True
+            continue
+
+        # Overlap of the ellipses, see helpers.ellipses_overlap
+        dist = np.sqrt(dra**2 + ddec**2)
+
+        theta = np.arctan2(dra, ddec)
+        t1 = theta - np.radians(PA)
+        t2 = theta - np.radians(pa_list[j])
+        den_1 = np.sqrt((b1*np.cos(t1))**2 + (a1*np.sin(t1))**2)
+        den_2 = np.sqrt((b2*np.cos(t2))**2 + (a2*np.sin(t2))**2)
+        radius = 0.
+        if den_1 > 0:
+            radius += a1*b1/den_1
+        if den_2 > 0:
+            radius += a2*b2/den_2
+        if radius >= dist:
+            matched[j] = True
+            continue
+        support = (np.sqrt((a1*np.cos(t1))**2 + (b1*np.sin(t1))**2) +
+                   np.sqrt((a2*np.cos(t2))**2 + (b2*np.sin(t2))**2))
+        if support < dist:
+            continue
+
+        for k in range(nsamples):
+            s = 2*np.pi*k/nsamples
+            x = dra + a2*np.cos(s)*sin_pa2 + b2*np.sin(s)*cos_pa2
+            y = ddec + a2*np.cos(s)*cos_pa2 - b2*np.sin(s)*sin_pa2
+            if (((x*sin_pa1 + y*cos_pa1)*b1)**2 + ((x*cos_pa1 - y*sin_pa1)*a1)**2) <= (a1*b1)**2:
+                matched[j] = True
+                break
+            x = a1*np.cos(s)*sin_pa1 + b1*np.sin(s)*cos_pa1 - dra
+            y = a1*np.cos(s)*cos_pa1 - b1*np.sin(s)*sin_pa1 - ddec
+            if (((x*sin_pa2 + y*cos_pa2)*b2)**2 + ((x*cos_pa2 - y*sin_pa2)*a2)**2) <= (a2*b2)**2:
+                matched[j] = True
+                break
 
-        if column_dict['peak_flux']:
-            self.PeakFlux = catalog_entry[column_dict['peak_flux']]
-        if column_dict['total_flux']:
-            self.IntFlux = catalog_entry[column_dict['total_flux']]
+    return matched, wrapped
 
-        self.skycoord = SkyCoord(self.RA, self.DEC, unit='deg')
+if numba is not None:
+    match_ellipse_kernel = numba.njit(cache=True, fastmath=True)(match_ellipse_kernel)
 
-    def match(self, ra_list, dec_list, maj_list, min_list, pa_list, sigma_extent, search_dist, header):
-        '''
-        Match the ellipse with a (list of) source(s)
+def match_source(RA, DEC, Maj, Min, PA, ra_list, dec_list, maj_list, min_list, pa_list,
+                 FWHM_to_sigma_extent, search_dist, header, wcs=None):
+    '''
+    Match a source ellipse with a (list of) source(s), returns the
+    indices of the matching sources and their RA and DEC offsets in degrees
+
+    Keyword arguments:
+    RA, DEC, Maj, Min, PA (float) -- Position and shape of the source in degrees
+    ra_list -- Right ascension of sources
+    dec_list -- Declination of sources
+    FWHM_to_sigma_extent (float) -- Factor to convert FWHM to the matching extent
+    search_dist (float) -- Additional range in degrees
+    header -- WCS header of the pointing
+    wcs -- WCS object of the header (default = parse the header)
+    '''
+    if numba is not None:
+        maj_match, wrapped = match_ellipse_kernel(RA, DEC, Maj, Min, PA,
+                                                  ra_list, dec_list, maj_list, min_list, pa_list,
+                                                  FWHM_to_sigma_extent, search_dist)
+        wrapped_idx = np.flatnonzero(wrapped)
+    else:
+        # Haversine separation and tangent plane offsets in plain numpy,
+        # avoids creating SkyCoord objects for every call
+        #
+        dlat    = np.radians(dec_list - DEC)
+        dlon    = np.radians((ra_list - RA + 180.) % 360. - 180.)
+        cos_dec = np.cos(np.radians(DEC))
 
-        Keyword arguments:
-        ra_list -- Right ascension of sources
-        dec_list -- Declination of sources
-        separation (float) - Additional range in degrees
-        '''
-        offset_coord   = SkyCoord(ra_list, dec_list, unit='deg')
-        sky_separation = self.skycoord.separation(offset_coord) 
+        hav = np.sin(dlat/2.)**2 + cos_dec*np.cos(np.radians(dec_list))*np.sin(dlon/2.)**2
+        separation = 2*np.arcsin(np.sqrt(np.clip(hav, 0., 1.)))
+        sky_separation = np.degrees(separation)
 
         # this factor just increases the number of sources to check
         # so no harm to the process
-        # is of the order of sub-arcsec
-        #
-        dra, ddec           = self.skycoord.spherical_offsets_to(offset_coord)
-        deprojection_factor = (np.sqrt( (dra)**2 + (ddec)**2 ) / sky_separation).value
-
-        # The Gaussians are given in FWHM Bmaj, Bmin
-        # in order to obtain a source extend we use the 3 sigma extent
+        # is of the order of sub-arcsec, so use the
+        # second order expansion in the separation
         #
-        # https://ned.ipac.caltech.edu/level5/Leo/Stats2_3.html
-        #
-        FWHM_to_sigma_extent = sigma_extent / (2*np.sqrt(2*np.log(2)))
+        deprojection_factor = 1. + 0.5*separation**2
 
         # Check if sources match within Bmaj/2 boundaries
         # these source could match or not this needs to
         # be checked
         #
-        # CAUTION: self is related to the external catalogue
+        # CAUTION: the source is related to the external catalogue
         #
-        maj_match = sky_separation < FWHM_to_sigma_extent * deprojection_factor * (self.Maj/2. + maj_list/2.) + search_dist
+        maj_match = sky_separation < FWHM_to_sigma_extent * deprojection_factor * (Maj/2. + maj_list/2.) + search_dist
 
         # Check if sources match within Bmin/2 boundaries
         # these are the source we do not need to check 
         # further, they always match
         #
-        min_match = sky_separation <= FWHM_to_sigma_extent * (self.Min/2. + min_list/2.)
+        min_match = sky_separation <= FWHM_to_sigma_extent * (Min/2. + min_list/2.)
+
+        # Check out the source between the maj_match and min_match boundaries,
+        # min_match implies maj_match so the sources in this band are simply
+        # the maj_match sources that are not a min_match
+        #
+        maj_match |= min_match
+        msource_idx = np.flatnonzero(maj_match & ~min_match)
+
+        wrapped_idx = np.array([], dtype=int)
+        if msource_idx.size > 0:
+
+            # Ellipse axes are given as FWHM so use half of the extent
+            #
+            dra  = np.degrees(dlon[msource_idx]*cos_dec)
+            ddec = np.degrees(dlat[msource_idx])
+            a1   = FWHM_to_sigma_extent*Maj/2.
+            b1   = FWHM_to_sigma_extent*Min/2.
+            a2   = (FWHM_to_sigma_extent*maj_list[msource_idx]+search_dist)/2.
+            b2   = (FWHM_to_sigma_extent*min_list[msource_idx]+search_dist)/2.
+            pa2  = pa_list[msource_idx]
+
+            # Sources of which the bounding boxes do not overlap
+            # never match, only check the remaining ones further
+            #
+            half_ra1, half_dec1 = helpers.ellipse_bounding_box(a1, b1, PA)
+            half_ra2, half_dec2 = helpers.ellipse_bounding_box(a2, b2, pa2)
+            in_box = (np.abs(dra) <= half_ra1 + half_ra2) & (np.abs(ddec) <= half_dec1 + half_dec2)
+
+            maj_match[msource_idx] = in_box
+            msource_idx = msource_idx[in_box]
+
+            # Check the overlap of the ellipses analytically in the tangent plane
+            #
+            maj_match[msource_idx] = helpers.ellipses_overlap(dra[in_box], ddec[in_box],
+                                                              a1, b1, PA,
+                                                              a2[in_box], b2[in_box], pa2[in_box])
+
+            wrapped_idx = msource_idx[abs(ra_list[msource_idx] - RA) > 300]
+
+    # Sources on opposite sides of RA = 0 are checked with their polygons
+    #
+    for s in wrapped_idx:
+        check_source = helpers.ellipse_skyprojection(RA,DEC,
+                                             FWHM_to_sigma_extent*Maj,
+                                             FWHM_to_sigma_extent*Min,
+                                             PA, header, wcs)
+
+        to_sources   = helpers.ellipse_skyprojection(ra_list[s],dec_list[s],
+                                             FWHM_to_sigma_extent*maj_list[s]+search_dist,
+                                             FWHM_to_sigma_extent*min_list[s]+search_dist,
+                                             pa_list[s], header, wcs)
+
+        do_they_overlap = False
+        split_check_s_source  = helpers.ellipse_RA_check(check_source)
+        split_to_s_sources    = helpers.ellipse_RA_check(to_sources)
+
+        for a in range(len(split_check_s_source)):
+            for b in range(len(split_to_s_sources)):
+                do_they_overlap_split = np.invert(Polygon(split_check_s_source[a]).intersection(Polygon(split_to_s_sources[b])).is_empty)
+                if do_they_overlap_split == True:
+                    do_they_overlap = True
+
+        # adjust the matching of the major_matches and exclude sources 
+        #
+        maj_match[s]    = do_they_overlap
 
-        # Check out the source between the maj_match and min_match boundaries
+    # Offsets of the matched sources, reused for the match information
+    #
+    idx = np.where(maj_match)[0]
+    dra, ddec = helpers.sky_offsets(RA, DEC, ra_list[idx], dec_list[idx])
+
+    return idx, dra, ddec
+
+def normalize_table(table, size_unit=None, flux_div=None):
+    '''
+    Convert the positions and source sizes of a queried catalog to degrees
+    and the fluxes to Jy, in place
+
+    Keyword arguments:
+    size_unit -- Unit of the Maj and Min columns if the table does not set it
+    flux_div (float) -- Divide the fluxes by this factor to convert to Jy
+                        (default = convert the flux columns using their units)
+    '''
+    if size_unit is not None:
+        table['Maj'].unit = size_unit
+        table['Min'].unit = size_unit
+
+    # Only convert the columns that are not in degrees yet
+    for col in ['RA','DEC','Maj','Min']:
+        if table[col].unit != u.deg:
+            table[col] = table[col].to(u.deg)
+
+    if flux_div is not None:
+        table['Peak_flux'] /= flux_div
+        table['Total_flux'] /= flux_div
+    else:
+        table['Peak_flux'] = table['Peak_flux'].to(u.Jy / u.beam) #convert to Jy/beam
+        table['Total_flux'] = table['Total_flux'].to(u.Jy) #convert to Jy
+
+class SourceCatalog:
+    '''
+    Sources of a catalog stored as arrays
+    '''
+
+    def set_sources(self, column_dict):
+        # Keep the columns as contiguous native float64 arrays, table columns
+        # read from FITS are big-endian and can be strided views of the rows
         #
-        if max(np.array(np.where(np.logical_xor(min_match,maj_match))).shape) > 0:
-
-            msource_idx = np.where(np.logical_xor(min_match,maj_match))[0].flatten()
-            for s in msource_idx:
-                check_source = helpers.ellipse_skyprojection(self.RA,self.DEC,
-                                                     FWHM_to_sigma_extent*self.Maj,
-                                                     FWHM_to_sigma_extent*self.Min,
-                                                     self.PA, header)
-
-                to_sources   = helpers.ellipse_skyprojection(ra_list[s],dec_list[s],
-                                                     FWHM_to_sigma_extent*maj_list[s]+search_dist,
-                                                     FWHM_to_sigma_extent*min_list[s]+search_dist,
-                                                     pa_list[s], header)
-
-                # this is to check if sources are crossing the 360 deg in RA
-                #
-                ra_check_s       = abs(np.diff(check_source[:,0])) > 300
-                ra_check_s_where = np.where(ra_check_s)[0]
-
-                ra_to_s       = abs(np.diff(to_sources[:,0])) > 300
-                ra_to_s_where = np.where(ra_to_s)[0]
-
-                if max(ra_check_s_where.shape) > 0 or max(ra_to_s_where.shape) > 0:
-
-                    do_they_overlap = False
-                    split_check_s_source  = helpers.ellipse_RA_check(check_source)
-                    split_to_s_sources    = helpers.ellipse_RA_check(to_sources)
-
-                    for a in range(len(split_check_s_source)):
-                        for b in range(len(split_to_s_sources)):
-                            do_they_overlap_split = np.invert(Polygon(split_check_s_source[a]).intersection(Polygon(split_to_s_sources[b])).is_empty)
-                            if do_they_overlap_split == True:
-                                do_they_overlap = True
-                            #
-                            del do_they_overlap_split
-                            gc.collect()
-
-                else:
-                    # this is a realy cool thing
-                    # use vertices to a Polygon and shapely to check if they intersect
-                    # https://gis.stackexchange.com/questions/243459/drawing-ellipse-with-shapely/243462#243462
-                    do_they_overlap = np.invert(Polygon(check_source).intersection(Polygon(to_sources)).is_empty)
-                    #
-
-                # adjust the matching of the major_matches and exclude sources 
-                #
-                maj_match[s]    = do_they_overlap
-
-                del do_they_overlap,check_source,to_sources
-                gc.collect()
-
-        return np.where(maj_match)[0]
-
-    def to_artist(self):
+        self.ra  = np.ascontiguousarray(self.cat[column_dict['ra']], dtype=np.float64)
+        self.dec = np.ascontiguousarray(self.cat[column_dict['dec']], dtype=np.float64)
+        self.maj = np.ascontiguousarray(self.cat[column_dict['majax']], dtype=np.float64)
+        self.min = np.ascontiguousarray(self.cat[column_dict['minax']], dtype=np.float64)
+        self.pa  = np.ascontiguousarray(self.cat[column_dict['pa']], dtype=np.float64)
+
+        self.peak_flux = None
+        if column_dict['peak_flux']:
+            self.peak_flux = np.ascontiguousarray(self.cat[column_dict['peak_flux']], dtype=np.float64)
+        self.total_flux = None
+        if column_dict['total_flux']:
+            self.total_flux = np.ascontiguousarray(self.cat[column_dict['total_flux']], dtype=np.float64)
+
+        self.skycoord = SkyCoord(self.ra, self.dec, unit='deg')
+
+    def to_collection(self, idx, ax, **kwargs):
         '''
-        Convert the ellipse to a matplotlib artist
+        Convert the ellipses of the sources at indices idx to a single
+        matplotlib collection drawn in the data coordinates of ax
 
         CAUTION definition in matplotlib is 
         width is horizointal axis, height vertical axis, angle is anti-clockwise
         in order to match the astronomical definition PA from North clockwise
         height is major axis, width is minor axis and angle is -PA
         '''
-        return Ellipse(xy = (self.RA, self.DEC),
-                        width = self.Min,
-                        height = self.Maj,
-                        angle = -self.PA)
+        return EllipseCollection(widths = self.min[idx],
+                                 heights = self.maj[idx],
+                                 angles = -self.pa[idx],
+                                 units = 'xy',
+                                 offsets = np.column_stack((self.ra[idx], self.dec[idx])),
+                                 offset_transform = ax.transData,
+                                 **kwargs)
 
-class ExternalCatalog:
+class ExternalCatalog(SourceCatalog):
 
     def __init__(self, name, catalog, center):
         self.name = name
@@ -164,7 +326,7 @@ class ExternalCatalog:
         if name in ['NVSS','SUMSS','FIRST','TGSS']:
             columns = {'ra':'RA','dec':'DEC','majax':'Maj','minax':'Min',
                        'pa':'PA','peak_flux':'Peak_flux','total_flux':'Total_flux'}
-            self.sources = [SourceEllipse(source, columns) for source in self.cat]
+            self.set_sources(columns)
             beam, freq = helpers.get_beam(name, center.ra.deg, center.dec.deg)
 
             self.BMaj  = beam[0]
@@ -182,13 +344,13 @@ class ExternalCatalog:
             if  n_rejected > 0:
                 print(f'Excluding {n_rejected} sources that have a negative quality flag')
 
-            self.sources = [SourceEllipse(source, cat_info['data_columns']) for source in self.cat]
+            self.set_sources(cat_info['data_columns'])
             self.BMaj = cat_info['properties']['BMAJ']
             self.BMin = cat_info['properties']['BMIN']
             self.BPA  = cat_info['properties']['BPA']
             self.freq = cat_info['properties']['freq']
 
-class Pointing:
+class Pointing(SourceCatalog):
 
     def __init__(self, catalog, filename):
         self.dirname = os.path.dirname(filename)
@@ -199,13 +361,15 @@ class Pointing:
 
         columns = {'ra':'RA','dec':'DEC','majax':'Maj','minax':'Min',
                    'pa':'PA','peak_flux':'Peak_flux','total_flux':'Total_flux'}
-        self.sources = [SourceEllipse(source, columns) for source in self.cat]
+        self.set_sources(columns)
 
         # Parse meta
         header = catalog.meta
 
         # HRK
         self.header = catalog.meta
+        self.wcs_header = helpers.make_header(self.header)
+        self.wcs = WCS(self.wcs_header)
 
         self.telescope = header['SF_TELE'].replace("'","")
         self.BMaj = float(header['SF_BMAJ'])*3600 #arcsec
@@ -222,8 +386,9 @@ class Pointing:
 
         self.center = SkyCoord(float(header['CRVAL1'])*u.degree,
                                float(header['CRVAL2'])*u.degree)
+        self.cos_dec_center = np.cos(self.center.dec.rad)
         dec_fov = abs(float(header['CDELT1']))*float(header['CRPIX1'])*2
-        self.fov = dec_fov/np.cos(self.center.dec.rad) * u.degree
+        self.fov = dec_fov/self.cos_dec_center * u.degree
 
         try:
             self.name = header['OBJECT'].replace("'","")
@@ -241,18 +406,7 @@ class Pointing:
         if not nvsstable:
             sys.exit()
 
-        nvsstable['Maj'].unit = u.arcsec
-        nvsstable['Min'].unit = u.arcsec
-
-        nvsstable['Maj'] = nvsstable['Maj'].to(u.deg)
-        nvsstable['Min'] = nvsstable['Min'].to(u.deg)
-        nvsstable['PA']  = nvsstable['PA']
-
-        nvsstable['RA']  = nvsstable['RA'].to(u.deg)
-        nvsstable['DEC'] = nvsstable['DEC'].to(u.deg)
-
-        nvsstable['Peak_flux'] /= 1e3 #convert to Jy
-        nvsstable['Total_flux'] /= 1e3 #convert to Jy
+        normalize_table(nvsstable, size_unit=u.arcsec, flux_div=1e3)
 
         return nvsstable
 
@@ -267,17 +421,7 @@ class Pointing:
         if not firsttable:
             sys.exit()
 
-        firsttable['Maj'].unit = u.arcsec
-        firsttable['Min'].unit = u.arcsec
-
-        firsttable['Maj'] = firsttable['Maj'].to(u.deg)
-        firsttable['Min'] = firsttable['Min'].to(u.deg)
-        firsttable['PA']  = firsttable['PA']
-        firsttable['RA']  = firsttable['RA'].to(u.deg)
-        firsttable['DEC'] = firsttable['DEC'].to(u.deg)
-
-        firsttable['Peak_flux'] /= 1e3 #convert to Jy
-        firsttable['Total_flux'] /= 1e3 #convert to Jy
+        normalize_table(firsttable, size_unit=u.arcsec, flux_div=1e3)
 
         return firsttable
 
@@ -286,13 +430,7 @@ class Pointing:
                                    dec = [self.center.dec.to_string(u.deg, sep=' ')],
                                    offset = 0.5*self.fov.to(u.arcmin).value)
 
-        tgsstable['Maj'] = tgsstable['Maj'].to(u.deg)
-        tgsstable['Min'] = tgsstable['Min'].to(u.deg)
-        tgsstable['RA']  = tgsstable['RA'].to(u.deg)
-        tgsstable['DEC'] = tgsstable['DEC'].to(u.deg)
-
-        tgsstable['Peak_flux'] = tgsstable['Peak_flux'].to(u.Jy / u.beam) #convert to Jy/beam
-        tgsstable['Total_flux'] = tgsstable['Total_flux'].to(u.Jy) #convert to Jy
+        normalize_table(tgsstable)
 
         return tgsstable
 
@@ -309,109 +447,167 @@ class Pointing:
                                      dec = self.center.dec,
                                      offset = 0.5*self.fov)
 
-        sumsstable['Maj'].unit = u.arcsec
-        sumsstable['Min'].unit = u.arcsec
-
-        sumsstable['Maj'] = sumsstable['Maj'].to(u.deg)
-        sumsstable['Min'] = sumsstable['Min'].to(u.deg)
-        sumsstable['PA']  = sumsstable['PA']
+        normalize_table(sumsstable, size_unit=u.arcsec, flux_div=1e3)
 
-        sumsstable['RA'] = sumsstable['RA'].to(u.deg)
-        sumsstable['DEC'] = sumsstable['DEC'].to(u.deg)
+        return sumsstable
 
-        sumsstable['Peak_flux'] /= 1e3 #convert to Jy
-        sumsstable['Total_flux'] /= 1e3 #convert to Jy
+# Catalogs used by match_worker, set by init_match_worker
+match_state = None
 
-        return sumsstable
+def init_match_worker(sources, candidates, ra_list, dec_list, maj_list, min_list, pa_list,
+                      FWHM_to_sigma_extent, search_dist, header, wcs):
+    '''
+    Store the catalogs in the (worker) process so that only the index
+    of the external source has to be passed for every match
+    '''
+    global match_state
+    match_state = {'sources':sources, 'candidates':candidates,
+                   'columns':(ra_list, dec_list, maj_list, min_list, pa_list),
+                   'FWHM_to_sigma_extent':FWHM_to_sigma_extent,
+                   'search_dist':search_dist, 'header':header, 'wcs':wcs}
 
-def match_catalogs(pointing, ext, sigma_extent, search_dist):
+def match_worker(i):
+    '''
+    Match external source i to its candidate sources in the pointing,
+    returns the indices of the matches and their offsets in degrees
+    '''
+    cand = match_state['candidates'][i]
+    if len(cand) == 0:
+        return np.array([], dtype=int), np.array([]), np.array([])
+
+    cand = np.array(cand)
+    match, dra, ddec = match_source(*[column[i] for column in match_state['sources']],
+                         *[column[cand] for column in match_state['columns']],
+                         match_state['FWHM_to_sigma_extent'],
+                         match_state['search_dist'],
+                         match_state['header'],
+                         match_state['wcs'])
+    return cand[match], dra, ddec
+
+def match_catalogs(pointing, ext, sigma_extent, search_dist, n_jobs=None):
     '''
     Match the sources of the chosen external catalog to the sources in the pointing
+
+    Keyword arguments:
+    n_jobs (int) -- Number of processes to match with (default = all available cores)
     '''
-    print(f'Matching {len(ext.sources)} sources in {ext.name} to {len(pointing.cat)} sources in the pointing')
+    print(f'Matching {len(ext.cat)} sources in {ext.name} to {len(pointing.cat)} sources in the pointing')
+
+    # Index the pointing sources on the unit sphere so only nearby
+    # sources have to be checked for every external source
+    #
+    tree = cKDTree(helpers.radec_to_cartesian(pointing.ra, pointing.dec))
+
+    # The Gaussians are given in FWHM Bmaj, Bmin
+    # in order to obtain a source extend we use the 3 sigma extent
+    #
+    # https://ned.ipac.caltech.edu/level5/Leo/Stats2_3.html
+    #
+    FWHM_to_sigma_extent = sigma_extent / (2*np.sqrt(2*np.log(2)))
+
+    # Largest separation at which any two sources can still match,
+    # the small margin covers the deprojection factor in the match.
+    # Sources without a valid size should not affect the others
+    #
+    max_maj = np.nanmax(ext.maj, initial=0) + np.nanmax(pointing.maj, initial=0)
+    max_dist = 1.01 * (FWHM_to_sigma_extent * max_maj/2. + search_dist)
+    chord_dist = 2*np.sin(np.radians(max_dist)/2.)
+
+    candidates = tree.query_ball_point(helpers.radec_to_cartesian(ext.ra, ext.dec), chord_dist)
+
+    match_args = ((ext.ra, ext.dec, ext.maj, ext.min, ext.pa), candidates,
+                  pointing.ra, pointing.dec, pointing.maj, pointing.min, pointing.pa,
+                  FWHM_to_sigma_extent, search_dist, pointing.wcs_header, pointing.wcs)
+
+    # Sources are sent to the processes in chunks of 64, by default
+    # a pool is not worth starting for only a couple of chunks
+    #
+    chunksize = 64
+    if n_jobs is None:
+        n_jobs = helpers.available_cpus()
+        if len(ext.cat) < 2*chunksize:
+            n_jobs = 1
+    elif n_jobs < 1:
+        print(f'Invalid number of processes {n_jobs}, please choose at least 1')
+        sys.exit()
+
+    if n_jobs == 1:
+        # Release the catalogs stored for the worker afterwards
+        global match_state
+        init_match_worker(*match_args)
+        try:
+            results = list(tqdm.tqdm(map(match_worker, range(len(ext.cat))),
+                                     total=len(ext.cat), desc='Matching..'))
+        finally:
+            match_state = None
+    else:
+        # Sources are matched independently, results come back in order
+        with multiprocessing.Pool(n_jobs, initializer=init_match_worker, initargs=match_args) as pool:
+            results = list(tqdm.tqdm(pool.imap(match_worker, range(len(ext.cat)), chunksize=chunksize),
+                                     total=len(ext.cat), desc='Matching..'))
 
-    matches = []
-    for source in tqdm.tqdm(ext.sources,desc='Matching..'):
-        matches.append(source.match(pointing.cat['RA'], pointing.cat['DEC'],
-                                    pointing.cat['Maj'],pointing.cat['Min'],
-                                    pointing.cat['PA'],
-                                    sigma_extent, search_dist,
-                                    helpers.make_header(pointing.header)))
+    matches = [match for match, dra, ddec in results]
 
-    return matches
+    # Offsets of all matched pairs, in the same order as the flattened matches
+    #
+    offsets = (np.concatenate([dra for match, dra, ddec in results] + [np.array([])]),
+               np.concatenate([ddec for match, dra, ddec in results] + [np.array([])]))
+
+    return matches, offsets
 
-def info_match(pointing, ext, matches, fluxtype, alpha, output):
+def info_match(pointing, ext, matches, offsets, fluxtype, alpha, output):
     """
     Provide information of the matches
+
+    Keyword arguments:
+    matches -- Indices of the pointing sources matched to every external source
+    offsets -- RA and DEC offsets in degrees of the matched pairs from match_catalogs
     """
     match_info = {}
 
-    dDEC      = []
-    dRA       = []
-    n_matches = []
+    # Flatten the matches into pairs of external and pointing sources
+    n_match = np.array([len(match) for match in matches], dtype=int)
+    match_i = np.repeat(np.arange(len(matches)), n_match)
+    match_j = np.concatenate(matches).astype(int) if len(matches) > 0 else np.array([], dtype=int)
+    # Determine the matches
+    n_matches = np.repeat(n_match, n_match)
 
-    for i, match in enumerate(matches):
-        if len(match) > 0:
-            for m in match:
-                # Determine the offset
-                dra, ddec = ext.sources[i].skycoord.spherical_offsets_to(pointing.sources[m].skycoord)
-                dRA.append(dra.arcsec)
-                dDEC.append(ddec.arcsec)
-                # Determine the matches
-                n_matches.append(len(match))
+    # Offsets of all matched pairs are already determined while matching
+    dra, ddec = offsets
 
     match_info['offset'] = {}
-    match_info['offset']['dRA']       = np.array(dRA)
-    match_info['offset']['dDEC']      = np.array(dDEC)
+    match_info['offset']['dRA']       = dra*3600
+    match_info['offset']['dDEC']      = ddec*3600
     match_info['offset']['n_matches'] = n_matches
 
     stats_data     = ['dRA','dDEC']
-    get_stats      = [np.min,np.max,np.std,np.mean,np.median,len]
-    #
-    matching_class = list(np.unique(n_matches))
-    matching_class.append('Full')
 
     match_info['offset']['stats'] = {}
     # get stats
     for mmdat in stats_data:
-        match_info['offset']['stats'][mmdat]={}
-        for cl in matching_class:
-            match_info['offset']['stats'][mmdat][str(cl)] = {}
-
-            if cl == 'Full':
-                stats_select = np.ones(len(n_matches)).astype(dtype=bool)
-            else:
-                stats_select = match_info['offset']['n_matches'] == cl
-
-            for getst in get_stats:
-                match_info['offset']['stats'][mmdat][str(cl)][getst.__name__] = getst((match_info['offset'][mmdat][stats_select]))
+        match_info['offset']['stats'][mmdat] = helpers.group_statistics(match_info['offset'][mmdat],
+                                                                        match_info['offset']['n_matches'])
 
     match_info['fluxes'] = {}
 
-    ext_flux    = []
-    int_flux    = []
-    separation  = []
-    n_matches  = []
     if fluxtype == 'Total':
-        for i, match in enumerate(matches):
-            if len(match) > 0:
-                ext_flux.append(ext.sources[i].IntFlux)
-                int_flux.append(np.sum([pointing.sources[m].IntFlux for m in match]))
-                source_coord = SkyCoord(ext.sources[i].RA, ext.sources[i].DEC, unit='deg')
-                separation.append(source_coord.separation(pointing.center).deg)
-                n_matches.append(len(match))
+        ext_fluxes = ext.total_flux
+        pointing_fluxes = pointing.total_flux
     elif fluxtype == 'Peak':
-        for i, match in enumerate(matches):
-            if len(match) > 0:
-                ext_flux.append(ext.sources[i].PeakFlux)
-                int_flux.append(np.sum([pointing.sources[m].PeakFlux for m in match]))
-                source_coord = SkyCoord(ext.sources[i].RA, ext.sources[i].DEC, unit='deg')
-                separation.append(source_coord.separation(pointing.center).deg)
-                n_matches.append(len(match))
+        ext_fluxes = ext.peak_flux
+        pointing_fluxes = pointing.peak_flux
     else:
         print(f'Invalid fluxtype {fluxtype}, choose between Total or Peak flux')
         sys.exit()
 
+    # Sum the fluxes of all pointing sources matched to each external source
+    matched  = n_match > 0
+    ext_flux = ext_fluxes[matched]
+    int_flux = np.bincount(match_i, weights=pointing_fluxes[match_j],
+                           minlength=len(matches))[matched]
+    separation = ext.skycoord[matched].separation(pointing.center).deg
+    n_matches  = n_match[matched]
+
     match_info['fluxes'][fluxtype] = {}
     match_info['fluxes'][fluxtype]['ext_flux']   = ext_flux
     match_info['fluxes'][fluxtype]['int_flux']   = int_flux
@@ -426,25 +622,12 @@ def info_match(pointing, ext, matches, fluxtype, alpha, output):
     match_info['fluxes'][fluxtype]['dFlux'] = dFlux
 
     stats_data     = ['dFlux']
-    get_stats      = [np.min,np.max,np.std,np.mean,np.median,len]
-    #
-    matching_class = list(np.unique(n_matches))
-    matching_class.append('Full')
 
     match_info['fluxes']['stats'] = {}
     # get stats
     for mmdat in stats_data:
-        match_info['fluxes']['stats'][mmdat]={}
-        for cl in matching_class:
-            match_info['fluxes']['stats'][mmdat][str(cl)] = {}
-
-            if cl == 'Full':
-                stats_select = np.ones(len(n_matches)).astype(dtype=bool)
-            else:
-                stats_select = match_info['fluxes'][fluxtype]['n_matches'] == cl
-
-            for getst in get_stats:
-                match_info['fluxes']['stats'][mmdat][str(cl)][getst.__name__] = getst((match_info['fluxes'][fluxtype][mmdat][stats_select]))
+        match_info['fluxes']['stats'][mmdat] = helpers.group_statistics(match_info['fluxes'][fluxtype][mmdat],
+                                                                        match_info['fluxes'][fluxtype]['n_matches'])
 
     return match_info
 
@@ -455,32 +638,22 @@ def plot_catalog_match(pointing, ext, matches, plot, dpi):
     fig = plt.figure(figsize=(20,20))
     ax = plt.subplot()
 
-    for i, match in enumerate(matches):
-        ext_ell = ext.sources[i].to_artist()
-        ax.add_artist(ext_ell)
-        ext_ell.set_facecolor('b')
-        ext_ell.set_alpha(0.5)
-
-        if len(match) > 0:
-            for ind in match:
-                ell = pointing.sources[ind].to_artist()
-                ax.add_artist(ell)
-                ell.set_facecolor('r')
-                ell.set_alpha(0.5)
-        else:
-            ext_ell.set_facecolor('k')
+    n_match = np.array([len(match) for match in matches], dtype=int)
+    matched = np.concatenate(matches).astype(int) if len(matches) > 0 else np.array([], dtype=int)
 
-    non_matches = np.setdiff1d(np.arange(len(pointing.sources)), np.concatenate(matches).ravel())
-    for i in non_matches:
-        ell = pointing.sources[i].to_artist()
-        ax.add_artist(ell)
-        ell.set_facecolor('g')
-        ell.set_alpha(0.5)
+    ext_colors = np.where(n_match > 0, 'b', 'k')
+    ax.add_collection(ext.to_collection(np.arange(len(matches)), ax, facecolors=ext_colors, alpha=0.5))
+    ax.add_collection(pointing.to_collection(matched, ax, facecolors='r', alpha=0.5))
+
+    seen = np.zeros(len(pointing.cat), dtype=bool)
+    seen[matched] = True
+    non_matches = np.flatnonzero(~seen)
+    ax.add_collection(pointing.to_collection(non_matches, ax, facecolors='g', alpha=0.5))
 
     ax.set_xlim(pointing.center.ra.deg-0.5*pointing.fov.value,
                 pointing.center.ra.deg+0.5*pointing.fov.value)
-    ax.set_ylim(pointing.center.dec.deg-0.5*pointing.fov.value*np.cos(pointing.center.dec.rad),
-                pointing.center.dec.deg+0.5*pointing.fov.value*np.cos(pointing.center.dec.rad))
+    ax.set_ylim(pointing.center.dec.deg-0.5*pointing.fov.value*pointing.cos_dec_center,
+                pointing.center.dec.deg+0.5*pointing.fov.value*pointing.cos_dec_center)
     ax.set_xlabel('RA (degrees)')
     ax.set_ylabel('DEC (degrees)')
 
@@ -707,13 +880,15 @@ def write_info(pointing, ext, match_info, output):
     """
     filename = os.path.join(pointing.dirname, f'match_{ext.name}_{pointing.name}_info.json')
 
+    # Convert numpy types once instead of per value in the encoder
+    match_info = helpers.to_builtin(match_info)
+
     # Write JSON file
     with open(filename, 'w') as outfile:
-            json.dump(match_info,outfile,
-                      indent=4, sort_keys=True,
-                      separators=(',', ': '),
-                      ensure_ascii=False,
-                      cls=NumpyEncoder)
+        json.dump(match_info,outfile,
+                  indent=4, sort_keys=True,
+                  separators=(',', ': '),
+                  ensure_ascii=False)
 
 def main():
 
@@ -735,6 +910,7 @@ def main():
 
     sigma_extent = args.match_sigma_extent
     search_dist  = args.search_dist/3600 # to degrees
+    n_jobs       = args.n_jobs
 
     pointing_cat = Table.read(pointing)
     pointing = Pointing(pointing_cat, pointing)
@@ -765,8 +941,8 @@ def main():
         print('No sources were found to match, most likely the external catalog has no coverage here')
         exit()
 
-    matches      = match_catalogs(pointing, ext_catalog, sigma_extent, search_dist)
-    matches_info = info_match(pointing, ext_catalog, matches, fluxtype, alpha, output)
+    matches, offsets = match_catalogs(pointing, ext_catalog, sigma_extent, search_dist, n_jobs)
+    matches_info = info_match(pointing, ext_catalog, matches, offsets, fluxtype, alpha, output)
 
     matches_info['INPUT'] = {}
     matches_info['INPUT']['alpha'] = alpha 
@@ -806,6 +982,9 @@ def new_argument_parser():
     parser.add_argument("--search_dist", default=0, type=float,
                         help="""Additional search distance beyond the source size to be
                                 used for matching, in arcseconds (default = 0)""")
+    parser.add_argument("-j", "--n_jobs", default=None, type=int,
+                        help="""Number of processes to use for matching the sources
+                                (default = use all cores available to the process).""")
     parser.add_argument("--astro", nargs="?", const=True,
                         help="""Plot the astrometric offset of the matches,
                                 optionally provide an output filename
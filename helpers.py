@@ -5,6 +5,8 @@ import astropy.wcs as WCS
 from matplotlib.patches import Ellipse
 
 from pathlib import Path
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pickle
 import json
@@ -20,6 +22,21 @@ def pickle_from_file(fname):
     fh.close()
     return data
 
+def to_builtin(data):
+    '''
+    Recursively convert numpy arrays and scalars in (nested) dictionaries
+    and lists to python lists and scalars, e.g. for writing json files
+    '''
+    if isinstance(data, dict):
+        return {key: to_builtin(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [to_builtin(value) for value in data]
+    if isinstance(data, np.ndarray):
+        return data.tolist()
+    if isinstance(data, np.generic):
+        return data.item()
+    return data
+
 def meerkat_lpb(a, b, freq, offset):
     '''
     MeerKAT L-band primary beam from Mauch et al 2019
@@ -85,6 +102,22 @@ def make_header(catheader):
 
     return wcsheader
 
+def radec_to_cartesian(ra, dec):
+    """
+    Convert sky positions to unit vectors on the sphere
+
+    Keyword arguments:
+    ra (array) -- Right ascension in degrees
+    dec (array) -- Declination in degrees
+    """
+    ra_rad = np.radians(np.asarray(ra, dtype=float))
+    dec_rad = np.radians(np.asarray(dec, dtype=float))
+    cos_dec = np.cos(dec_rad)
+
+    return np.column_stack((cos_dec*np.cos(ra_rad),
+                            cos_dec*np.sin(ra_rad),
+                            np.sin(dec_rad)))
+
 def get_beam(identity, ra_center, dec_center):
     '''
     Get the beam and frequency of a given survey. As for some surveys
@@ -121,7 +154,55 @@ def get_beam(identity, ra_center, dec_center):
     beam = [BMaj,BMin,BPA]
     return beam, freq
 
-def measure_image_regions(pixel_regions, image, weight_image=None):
+def available_cpus():
+    '''
+    Number of cores this process is allowed to run on, which can be
+    less than the number of cores of the machine on a batch node
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    else:
+        return os.cpu_count() or 1
+
+def measure_region(region, image, weight_image=None):
+    '''
+    Measure the weighted mean and standard deviation in an image
+    from a given region, masked if the region contains too few
+    valid pixels
+
+    Keyword arguments:
+    region        -- Region of pixels to get values from
+    image         -- Image to measure values from
+    weight_image  -- Optional image containing weights
+    '''
+    # Only use the cutout of the region, not the full image
+    mask = region.to_mask(mode='center')
+    slices_large, slices_small = mask.get_overlap_slices(image.shape)
+    if slices_large is None:
+        return np.ma.masked, np.ma.masked
+    mask_data = mask.data[slices_small].astype(bool)
+
+    image_values = image[slices_large][mask_data]
+    image_values = np.ma.filled(image_values, np.nan)
+
+    nan_values = np.isnan(image_values)
+    image_values = image_values[~nan_values]
+    if weight_image is None:
+        weights = np.ones(image_values.shape)
+    else:
+        weights = weight_image[slices_large][mask_data]
+        weights = weights[~nan_values]
+
+    # Get weighted mean and standard deviations
+    if len(image_values) > 0.5*np.sum(mask_data):
+        mean = np.nansum(image_values*weights)/np.sum(weights)
+        std = np.sqrt(np.nansum(weights*(image_values-mean)**2) /
+                     (np.sum(weights)*(len(weights)-1 / len(weights))))
+        return mean, std
+    else:
+        return np.ma.masked, np.ma.masked
+
+def measure_image_regions(pixel_regions, image, weight_image=None, n_jobs=None):
     '''
     Measure values in images an from given regions
 
@@ -129,39 +210,69 @@ def measure_image_regions(pixel_regions, image, weight_image=None):
     pixel_ragions -- Regions of pixels to get values from
     image         -- Image to measure values from
     weight_image  -- Optional image containing weights
+    n_jobs        -- Number of threads to measure with (default = up to 4)
     '''
-    values = []
-    err_values = []
-    # Measure value for each source
-    for region in pixel_regions:
-        mask = region.to_mask(mode='center')
-        mask_data = mask.to_image(image.shape).astype(bool)
-
-        image_values = image[mask_data]
-        image_values = image_values.filled(np.nan)
-
-        nan_values = np.isnan(image_values)
-        image_values = image_values[~nan_values]
-        if weight_image is None:
-            weights = np.ones(image_values.shape)
-        else:
-            weights = weight_image[mask_data]
-            weights = weights[~nan_values]
-
-        # Get weighted mean and standard deviations
-        if len(image_values) > 0.5*np.sum(mask_data):
-            mean = np.nansum(image_values*weights)/np.sum(weights)
-            std = np.sqrt(np.nansum(weights*(image_values-mean)**2) /
-                         (np.sum(weights)*(len(weights)-1 / len(weights))))
-            values.append(mean)
-            err_values.append(std)
-        else:
-            values.append(np.ma.masked)
-            err_values.append(np.ma.masked)
+    # Measure value for each source, the regions are independent and
+    # numpy releases the GIL on the image operations so use threads
+    # which share the images instead of copying them to processes.
+    # The work on the small cutouts is memory bound, so a few threads
+    # are enough
+    #
+    if n_jobs is None:
+        n_jobs = min(4, available_cpus())
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(lambda region: measure_region(region, image, weight_image),
+                                    pixel_regions))
+
+    values = [value for value, err_value in results]
+    err_values = [err_value for value, err_value in results]
 
     return values, err_values
 
-def ellipse_skyprojection(ra, dec, Bmaj, Bmin, PA, header=None):
+def group_statistics(values, groups):
+    '''
+    Get the min, max, std, mean, median and number of values for every
+    group of values, and for all values together under 'Full'. All groups
+    are handled in one pass over the values sorted by group.
+
+    Keyword arguments:
+    values (array) -- Values to get the statistics of
+    groups (array) -- Group label of each value
+    '''
+    get_stats = [np.min,np.max,np.std,np.mean,np.median,len]
+    values = np.asarray(values, dtype=float)
+    groups = np.asarray(groups)
+
+    stats = {}
+    if len(values) > 0:
+        # sort by group and by value within each group
+        order = np.lexsort((values, groups))
+        sorted_values = values[order]
+        classes, starts, counts = np.unique(groups[order], return_index=True, return_counts=True)
+        ends = starts + counts - 1
+
+        mean = np.add.reduceat(sorted_values, starts)/counts
+        std = np.sqrt(np.add.reduceat((sorted_values - np.repeat(mean, counts))**2, starts)/counts)
+        median = 0.5*(sorted_values[starts + (counts-1)//2] + sorted_values[starts + counts//2])
+
+        # NaN values are sorted last, groups containing them get NaN
+        # for every statistic like the numpy reductions give
+        #
+        has_nan = np.add.reduceat(np.isnan(sorted_values), starts) > 0
+        minimum = np.where(has_nan, np.nan, sorted_values[starts])
+        median = np.where(has_nan, np.nan, median)
+
+        group_stats = dict(zip([getst.__name__ for getst in get_stats],
+                               [minimum, sorted_values[ends], std, mean, median, counts]))
+        for i, cl in enumerate(classes):
+            stats[str(cl)] = {name: group_values[i] for name, group_values in group_stats.items()}
+
+    stats['Full'] = {getst.__name__: getst(values) for getst in get_stats}
+
+    return stats
+
+def ellipse_skyprojection(ra, dec, Bmaj, Bmin, PA, header=None, wcs=None):
     """
     Provide real pixel values for deprojected Ellipse in
     tha tangent plane
@@ -170,9 +281,13 @@ def ellipse_skyprojection(ra, dec, Bmaj, Bmin, PA, header=None):
     width horizontal axis, height vertical axis, angle is anti-clockwise
     in order to match the astronomical definition PA from North clockwise
     height is major axis, width is minor axis and angle is -PA
+
+    Pass the WCS of the header as well if it is available,
+    so it does not have to be parsed for every ellipse
     """
     if header != None:
-        wcs = WCS.WCS(header)
+        if wcs is None:
+            wcs = WCS.WCS(header)
         source_centre_position = SkyCoord(ra*u.deg,dec*u.deg, frame='icrs')
         source_centre_position_pix_xy = list(np.array(WCS.utils.skycoord_to_pixel(source_centre_position,wcs)).flatten())
 
@@ -206,6 +321,104 @@ def ellipse_skyprojection(ra, dec, Bmaj, Bmin, PA, header=None):
 
     return Ellipse_SKY
 
+def sky_offsets(ra1, dec1, ra2, dec2):
+    """
+    Offsets of the positions (ra2, dec2) in the frame centred on (ra1, dec1),
+    the same as SkyCoord.spherical_offsets_to but without creating
+    SkyCoord objects
+
+    Keyword arguments:
+    ra1, dec1 -- Position(s) of the frame origin in degrees
+    ra2, dec2 -- Position(s) to determine the offsets of in degrees
+    """
+    dra_rad  = np.radians(np.asarray(ra2, dtype=float) - ra1)
+    dec1_rad = np.radians(dec1)
+    dec2_rad = np.radians(dec2)
+
+    # Rotate the positions so the origin ends up at (0,0)
+    x = np.cos(dec1_rad)*np.cos(dec2_rad)*np.cos(dra_rad) + np.sin(dec1_rad)*np.sin(dec2_rad)
+    y = np.cos(dec2_rad)*np.sin(dra_rad)
+    z = np.cos(dec1_rad)*np.sin(dec2_rad) - np.sin(dec1_rad)*np.cos(dec2_rad)*np.cos(dra_rad)
+
+    dra  = np.degrees(np.arctan2(y, x))
+    ddec = np.degrees(np.arctan2(z, np.hypot(x, y)))
+
+    return dra, ddec
+
+def ellipse_bounding_box(a, b, pa):
+    """
+    Half widths of the bounding box of an ellipse towards east and north
+
+    Keyword arguments:
+    a, b -- Semi-major and semi-minor axis
+    pa -- Position angle of the major axis (degrees, north through east)
+    """
+    sin_pa = np.sin(np.radians(pa))
+    cos_pa = np.cos(np.radians(pa))
+
+    half_ra  = np.sqrt((a*sin_pa)**2 + (b*cos_pa)**2)
+    half_dec = np.sqrt((a*cos_pa)**2 + (b*sin_pa)**2)
+
+    return half_ra, half_dec
+
+def ellipses_overlap(dx, dy, a1, b1, pa1, a2, b2, pa2, nsamples=90):
+    """
+    Check if pairs of ellipses overlap in the tangent plane
+
+    The line connecting the centres decides most pairs: if the radii of
+    the ellipses along it add up to the distance the ellipses overlap, if
+    their projections onto it do not reach the distance they do not. The
+    remaining pairs are checked by sampling the boundary of each ellipse
+    and testing whether any point lies inside the other ellipse.
+
+    Keyword arguments:
+    dx, dy (array) -- Offset of the second ellipses towards east and north
+    a1, b1, pa1 -- Semi-major, semi-minor axis and PA (degrees, north through east)
+                   of the first ellipses, in the same units as dx, dy
+    a2, b2, pa2 -- Semi-major, semi-minor axis and PA of the second ellipses
+    nsamples (int) -- Number of points to sample on the boundaries
+    """
+    dx, dy, a1, b1, pa1, a2, b2, pa2 = np.broadcast_arrays(
+        *[np.asarray(x, dtype=float) for x in (dx, dy, a1, b1, pa1, a2, b2, pa2)])
+
+    dist = np.hypot(dx, dy)
+    # position angle of the line connecting the centres
+    theta = np.arctan2(dx, dy)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = theta - np.radians(pa1)
+        t2 = theta - np.radians(pa2)
+
+        radius_1 = a1*b1/np.hypot(b1*np.cos(t1), a1*np.sin(t1))
+        radius_2 = a2*b2/np.hypot(b2*np.cos(t2), a2*np.sin(t2))
+        support_1 = np.hypot(a1*np.cos(t1), b1*np.sin(t1))
+        support_2 = np.hypot(a2*np.cos(t2), b2*np.sin(t2))
+
+        overlap = radius_1 + radius_2 >= dist
+        undecided = ~overlap & (support_1 + support_2 >= dist)
+
+        if np.any(undecided):
+            s = np.linspace(0, 2*np.pi, nsamples, endpoint=False)
+            dx, dy, a1, b1, pa1, a2, b2, pa2 = [x[undecided, None] for x in
+                                                (dx, dy, a1, b1, pa1, a2, b2, pa2)]
+            sin_pa1, cos_pa1 = np.sin(np.radians(pa1)), np.cos(np.radians(pa1))
+            sin_pa2, cos_pa2 = np.sin(np.radians(pa2)), np.cos(np.radians(pa2))
+
+            # Boundary points of the second ellipse relative to the first
+            # one, projected on the axes of the first ellipse
+            x = dx + a2*np.cos(s)*sin_pa2 + b2*np.sin(s)*cos_pa2
+            y = dy + a2*np.cos(s)*cos_pa2 - b2*np.sin(s)*sin_pa2
+            inside_1 = ((x*sin_pa1 + y*cos_pa1)/a1)**2 + ((x*cos_pa1 - y*sin_pa1)/b1)**2 <= 1
+
+            # and the other way around
+            x = a1*np.cos(s)*sin_pa1 + b1*np.sin(s)*cos_pa1 - dx
+            y = a1*np.cos(s)*cos_pa1 - b1*np.sin(s)*sin_pa1 - dy
+            inside_2 = ((x*sin_pa2 + y*cos_pa2)/a2)**2 + ((x*cos_pa2 - y*sin_pa2)/b2)**2 <= 1
+
+            overlap[undecided] = np.any(inside_1 | inside_2, axis=1)
+
+    return overlap
+
 def ellipse_RA_check(radec):
     """
     Split the polygons into sub-polygons to be checked
@@ -154,23 +154,22 @@ def matches_to_kvis(pointing, ext, matches, annotate, annotate_nonmatchedcat, si
     non_match_ext_lines = []
     for i, match in enumerate(matches):
         if len(match) > 0:
-            source = ext.sources[i]
-            toprt = f'ELLIPSE {source.RA:.6f} {source.DEC:.6f} {source.Maj*FWHMtosemimajmin:.6f} {source.Min*FWHMtosemimajmin:.6f} {source.PA:.4f} \n'
+            toprt = f'ELLIPSE {ext.ra[i]:.6f} {ext.dec[i]:.6f} {ext.maj[i]*FWHMtosemimajmin:.6f} {ext.min[i]*FWHMtosemimajmin:.6f} {ext.pa[i]:.4f} \n'
             match_ext_lines.append(toprt)
             for ind in match:
-                source = pointing.sources[ind]
-                toprt = f'ELLIPSE {source.RA:.6f} {source.DEC:.6f} {source.Maj*FWHMtosemimajmin:.6f} {source.Min*FWHMtosemimajmin:.6f} {source.PA:.4f} \n'
+                toprt = f'ELLIPSE {pointing.ra[ind]:.6f} {pointing.dec[ind]:.6f} {pointing.maj[ind]*FWHMtosemimajmin:.6f} {pointing.min[ind]*FWHMtosemimajmin:.6f} {pointing.pa[ind]:.4f} \n'
                 match_int_lines.append(toprt)
         else:
-            source = ext.sources[i]
-            toprt = f'ELLIPSE {source.RA:.6f} {source.DEC:.6f} {source.Maj*FWHMtosemimajmin:.6f} {source.Min*FWHMtosemimajmin:.6f} {source.PA:.4f} \n'
+            toprt = f'ELLIPSE {ext.ra[i]:.6f} {ext.dec[i]:.6f} {ext.maj[i]*FWHMtosemimajmin:.6f} {ext.min[i]*FWHMtosemimajmin:.6f} {ext.pa[i]:.4f} \n'
             non_match_ext_lines.append(toprt)
 
-    non_matches = np.setdiff1d(np.arange(len(pointing.sources)), np.concatenate(matches).ravel())
+    seen = np.zeros(len(pointing.cat), dtype=bool)
+    for match in matches:
+        seen[match] = True
+    non_matches = np.flatnonzero(~seen)
     non_match_int_lines = []
     for i in non_matches:
-        source = pointing.sources[i]
-        toprt = f'ELLIPSE {source.RA:.6f} {source.DEC:.6f} {source.Maj*FWHMtosemimajmin:.6f} {source.Min*FWHMtosemimajmin:.6f} {source.PA:.4f} \n'
+        toprt = f'ELLIPSE {pointing.ra[i]:.6f} {pointing.dec[i]:.6f} {pointing.maj[i]*FWHMtosemimajmin:.6f} {pointing.min[i]*FWHMtosemimajmin:.6f} {pointing.pa[i]:.4f} \n'
         non_match_int_lines.append(toprt)
 
     if annotate is True:
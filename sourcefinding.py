@@ -2,13 +2,17 @@
 
 import os
 import sys
+import shutil
 import json
 import ast
+import copy
+import functools
 
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.collections import EllipseCollection
 
 from argparse import ArgumentParser
 from pathlib import Path
@@ -21,12 +25,34 @@ from astropy.table import Table, Column
 from astropy.coordinates import SkyCoord
 from scipy import ndimage
 
-from regions import EllipseSkyRegion, Regions
+from regions import EllipseSkyRegion, EllipsePixelRegion, PixCoord, Regions
 
 import bdsf
 import casacore.images as pim
 import helpers
 
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+@functools.lru_cache(maxsize=None)
+def read_parset(path):
+    '''
+    Read a json parset with bdsf arguments, every parset is only parsed once
+
+    Keyword arguments:
+    path -- Path of the json parset
+    '''
+    with open(path) as f:
+        args_dict = json.load(f)
+
+    # Fix json stupidness
+    args_dict['process_image']['rms_box'] = ast.literal_eval(args_dict['process_image']['rms_box'])
+    args_dict['process_image']['rms_box_bright'] = ast.literal_eval(args_dict['process_image']['rms_box_bright'])
+
+    return args_dict
+
 def run_bdsf(image, output_dir, argfile, output_format):
     '''
     Run PyBDSF on an image
@@ -38,13 +64,9 @@ def run_bdsf(image, output_dir, argfile, output_format):
     '''
     imname = os.path.join(output_dir,os.path.basename(image).split('.')[0])
 
+    # Copy the cached arguments so they can not be changed between calls
     path = Path(__file__).parent / argfile
-    with open(path) as f:
-        args_dict = json.load(f)
-
-    # Fix json stupidness
-    args_dict['process_image']['rms_box'] = ast.literal_eval(args_dict['process_image']['rms_box'])
-    args_dict['process_image']['rms_box_bright'] = ast.literal_eval(args_dict['process_image']['rms_box_bright'])
+    args_dict = copy.deepcopy(read_parset(str(path)))
 
     img = bdsf.process_image(image, **args_dict['process_image'])
 
@@ -90,55 +112,87 @@ def run_bdsf(image, output_dir, argfile, output_format):
 
     return outcat, img
 
-def read_alpha(inpimage, catalog, regions):
+def casa_image_wcs(image):
+    '''
+    Get the celestial WCS of a casacore image from its direction coordinate
+
+    Keyword arguments:
+    image -- casacore image
+    '''
+    direction = image.coordinates().dict()['direction0']
+    unit = u.Unit(direction['units'][0])
+    projection = direction['projection']
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---'+projection, 'DEC--'+projection]
+    wcs.wcs.crval = (np.array(direction['crval'])*unit).to_value(u.deg)
+    wcs.wcs.cdelt = (np.array(direction['cdelt'])*unit).to_value(u.deg)
+    # casacore pixels are zero based
+    wcs.wcs.crpix = np.array(direction['crpix']) + 1
+    wcs.wcs.pc = np.array(direction['pc'])
+    wcs.wcs.set_pv([(2, i+1, value) for i, value in enumerate(direction['projection_parameters'])])
+
+    if direction['system'] == 'J2000':
+        wcs.wcs.radesys = 'FK5'
+        wcs.wcs.equinox = 2000.
+    elif direction['system'] == 'ICRS':
+        wcs.wcs.radesys = 'ICRS'
+
+    return wcs
+
+def read_alpha(inpimage, regions):
     '''
-    Determine spectral indices of the sources
+    Determine spectral indices of the sources, returns the new
+    columns and their indexes in the PyBDSF catalog
     '''
     imname = os.path.join(os.path.dirname(inpimage),
                           os.path.basename(inpimage).split('.')[0])
+
+    # Read the pixels directly instead of converting to FITS first,
+    # drop freq and stokes axes
+    #
     tt0 = pim.image(imname+'.image.tt0')
-    tt0.putmask(False)
-    tt0.tofits(imname+'_tt0.fits')
-    tt0 = fits.open(imname+'_tt0.fits')
+    tt0_data = tt0.getdata()[0,0]
 
     tt1 = pim.image(imname+'.image.tt1')
-    tt1.putmask(False)
-    tt1.tofits(imname+'_tt1.fits')
-    tt1 = fits.open(imname+'_tt1.fits')
+    tt1_data = tt1.getdata()[0,0]
 
-    # Get WCS from header and drop freq and stoke axes
-    wcs = WCS(tt0[0].header, naxis=2)
-    pixel_regions = [region.to_pixel(wcs) for region in regions]
+    wcs = casa_image_wcs(tt0)
+    pixel_regions = regions_to_pixel(regions, wcs)
 
-    alpha = tt1[0].data[0,0,:,:]/tt0[0].data[0,0,:,:]
+    alpha = tt1_data/tt0_data
     alpha = sigma_clip(alpha, sigma=3, masked=True)
 
-    # Smooth image with NaNs
-    U = alpha.filled(np.nan)
-    V = U.copy()
-    V[np.isnan(U)]=0
-    VV = ndimage.gaussian_filter(V, sigma=5, order=0)
+    # Smooth image with NaNs, in single precision and
+    # in place to limit the memory of the full size images
+    #
+    # The kernel is truncated at 2.5 sigma, the values are
+    # normalised by the smoothed weights so the truncation
+    # hardly changes the result
+    #
+    U = alpha.filled(np.nan).astype(np.float32, copy=False)
+    nan_values = np.isnan(U)
 
-    W = 0*U.copy()+1
-    W[np.isnan(U)]=0
-    WW = ndimage.gaussian_filter(V, sigma=5, order=0)
+    V = np.where(nan_values, np.float32(0), U)
+    ndimage.gaussian_filter(V, sigma=5, order=0, truncate=2.5, output=V)
 
-    alpha == VV/WW
-    alpha_list, alpha_err_list = helpers.measure_image_regions(pixel_regions, alpha, weight_image=tt1[0].data[0,0,:,:])
+    W = (~nan_values).astype(np.float32)
+    ndimage.gaussian_filter(W, sigma=5, order=0, truncate=2.5, output=W)
+
+    # Pixels without any valid neighbours stay masked
+    np.divide(V, W, out=V, where=W != 0)
+    alpha = np.ma.masked_array(V, mask=W == 0)
+    alpha_list, alpha_err_list = helpers.measure_image_regions(pixel_regions, alpha, weight_image=tt1_data)
 
     a = Column(alpha_list, name='Spectral_index')
     b = Column(alpha_err_list, name='E_Spectral_index')
-    catalog.add_columns([a,b], indexes=[10,10]) 
-
-    # Clean up
-    os.remove(imname+'_tt0.fits')
-    os.remove(imname+'_tt1.fits')
 
-    return catalog
+    return [a,b], [10,10]
 
 def transform_cat(catalog, survey_name, img, argfile):
     '''
-    Add names for sources in the catalog following IAU naming conventions
+    Add names for sources in the catalog following IAU naming conventions,
+    returns the new columns and their indexes in the PyBDSF catalog
     '''
     header = dict([x.split(' = ') for x in catalog.meta['comments'][4:]])
 
@@ -146,8 +200,7 @@ def transform_cat(catalog, survey_name, img, argfile):
                                float(header['CRVAL2'])*u.degree)
     pointing_name = ['PT-'+header['OBJECT'].replace("'","")] * len(catalog)
 
-    source_coord = SkyCoord([source['RA'] for source in catalog],
-                            [source['DEC'] for source in catalog],
+    source_coord = SkyCoord(catalog['RA'], catalog['DEC'],
                             unit=(u.deg,u.deg))
 
     if survey_name:
@@ -155,35 +208,43 @@ def transform_cat(catalog, survey_name, img, argfile):
     else:
         survey_name = ''
 
-    ids = [survey_name+'J{0}{1}'.format(coord.ra.to_string(unit=u.hourangle,
-                                                     sep='',
-                                                     precision=0,
-                                                     pad=True),
-                                 coord.dec.to_string(sep='',
-                                                      precision=0,
-                                                      alwayssign=True,
-                                                      pad=True)) for coord in source_coord]
-
-    sep = pointing_center.separation(source_coord)
+    ra_str = source_coord.ra.to_string(unit=u.hourangle,
+                                       sep='',
+                                       precision=0,
+                                       pad=True)
+    dec_str = source_coord.dec.to_string(sep='',
+                                         precision=0,
+                                         alwayssign=True,
+                                         pad=True)
+    ids = np.char.add(np.char.add(survey_name+'J', ra_str), dec_str)
+
+    # Separation from the pointing centre with the haversine formula
+    # on the plain arrays, a flat sky approximation is off by up to
+    # an arcminute at the edge of wide fields at low declination
+    #
+    dra = source_coord.ra.rad - pointing_center.ra.rad
+    ddec = source_coord.dec.rad - pointing_center.dec.rad
+    hav = (np.sin(ddec/2)**2 +
+           np.cos(pointing_center.dec.rad)*np.cos(source_coord.dec.rad)*np.sin(dra/2)**2)
+    sep = np.degrees(2*np.arcsin(np.sqrt(np.clip(hav, 0, 1))))*u.deg
     quality_flag = [1] * len(catalog)
 
-    # Add columns at appropriate indices
+    # Columns to add at appropriate indices
     col_a = Column(pointing_name, name='Pointing_id')
     col_b = Column(ids, name='Source_name')
     col_c = Column(sep, name='Sep_PC')
     col_d = Column(quality_flag, name='Quality_flag')
-    catalog.add_columns([col_a, col_b, col_c, col_d],
-                         indexes=[0,0,6,-1])
 
     # Update catalog meta
     catalog.meta['comments'] = catalog.meta['comments'][:2]
     catalog.meta.update(header)
 
-    # Change NAXIS keywords so that astropy doesn't complain
-    for key in ['NAXIS','NAXIS1','NAXIS2','NAXIS3','NAXIS4']:
-        replacement = {key:key.replace('N','')}
-        for k, v in list(catalog.meta.items()):
-            catalog.meta[replacement.get(k, k)] = catalog.meta.pop(k)
+    # Change NAXIS keywords so that astropy doesn't complain,
+    # rebuild the meta in one pass to keep the order of the keys
+    naxis_keys = ['NAXIS','NAXIS1','NAXIS2','NAXIS3','NAXIS4']
+    meta = [(k.replace('N','') if k in naxis_keys else k, v) for k, v in catalog.meta.items()]
+    catalog.meta.clear()
+    catalog.meta.update(meta)
 
     # Put beam and freq in header in case they're not already there
     catalog.meta['SF_BMAJ'] = img.beam[0]
@@ -191,7 +252,19 @@ def transform_cat(catalog, survey_name, img, argfile):
     catalog.meta['SF_BPA'] = img.beam[2]
     catalog.meta['SF_TELE'] = img._telescope
 
-    return catalog
+    return [col_a, col_b, col_c, col_d], [0,0,6,-1]
+
+def write_fits_catalog(catalog, outfile):
+    '''
+    Write a catalog to a FITS file, skipping the checksum and
+    verification of the output which the catalog does not need
+
+    Keyword arguments:
+    catalog -- Catalog to write
+    outfile -- Name of the output FITS file
+    '''
+    fits.table_to_hdu(catalog).writeto(outfile, overwrite=True,
+                                       checksum=False, output_verify='ignore')
 
 def catalog_to_regions(catalog, ra='RA', dec='DEC', majax='Maj', minax='Min', PA='PA'):
     '''
@@ -201,12 +274,46 @@ def catalog_to_regions(catalog, ra='RA', dec='DEC', majax='Maj', minax='Min', PA
     catalog -- Input catalog
     ra, dec, majax, minax, PA -- Column names of containing required variables
     '''
+    centers = SkyCoord(catalog[ra], catalog[dec], unit='deg')
+    height = u.Quantity(catalog[majax], u.deg)
+    width = u.Quantity(catalog[minax], u.deg)
+    angle = u.Quantity(catalog[PA], u.deg)
+
     regions = Regions([
-        EllipseSkyRegion(center=SkyCoord(source[ra], source[dec], unit='deg'),
-                         height=source[majax]*u.deg, width=source[minax]*u.deg,
-                         angle=source[PA]*u.deg) for source in catalog])
+        EllipseSkyRegion(center=centers[i],
+                         height=height[i], width=width[i],
+                         angle=angle[i]) for i in range(len(catalog))])
     return regions
 
+def regions_to_pixel(regions, wcs):
+    '''
+    Convert ellipse sky regions to pixel regions, transforming
+    all the centres with a single WCS call
+
+    Keyword arguments:
+    regions -- List of EllipseSkyRegion
+    wcs -- Celestial WCS of the image
+    '''
+    if len(regions) == 0:
+        return []
+
+    centers = SkyCoord([region.center for region in regions])
+    x, y = wcs.world_to_pixel(centers)
+
+    # Local pixel scale and direction of north, from an offset of 1 arcsec
+    #
+    x_north, y_north = wcs.world_to_pixel(centers.directional_offset_by(0*u.deg, 1*u.arcsec))
+    pixscale = 1/np.hypot(x_north - x, y_north - y)
+    north_angle = np.degrees(np.arctan2(y_north - y, x_north - x))
+
+    width = u.Quantity([region.width for region in regions]).to_value(u.arcsec)/pixscale
+    height = u.Quantity([region.height for region in regions]).to_value(u.arcsec)/pixscale
+    angle = u.Quantity([region.angle for region in regions]).to_value(u.deg) + north_angle - 90
+
+    pixel_regions = [EllipsePixelRegion(PixCoord(x[i], y[i]), width[i], height[i],
+                                        angle=angle[i]*u.deg) for i in range(len(regions))]
+    return pixel_regions
+
 def write_mask(outfile, regions, size=1.0):
     """
     Write an output file containing sources to mask
@@ -216,10 +323,12 @@ def write_mask(outfile, regions, size=1.0):
     regions -- Region or list of regions to write
     size -- Multiply input major and minor axes by this amount
     """
+    # Scale copies of the regions so the input regions are left untouched
     if size != 1.0:
-        for region in regions:
-            region.height *= size
-            region.width *= size
+        regions = Regions([EllipseSkyRegion(center=region.center,
+                                            height=region.height*size,
+                                            width=region.width*size,
+                                            angle=region.angle) for region in regions])
 
     print(f'Wrote mask file to {outfile}')
     regions.write(outfile, format='crtf')
@@ -228,12 +337,18 @@ def plot_sf_results(image_file, rms_image, regions, plot):
     '''
     Plot the results of the sourcefinding
     '''
-    image = fits.open(image_file)
-    rms = fits.open(rms_image)
-
-    img = image[0].data[0,0,:,:]
-    rms_img = rms[0].data[0,0,:,:]
-    wcs = WCS(image[0].header, naxis=2)
+    # Only read the plane that is plotted, with fitsio if available
+    wcs = WCS(fits.getheader(image_file), naxis=2)
+    if fitsio is not None:
+        with fitsio.FITS(image_file) as image:
+            img = image[0][0:1,0:1,:,:][0,0]
+        with fitsio.FITS(rms_image) as rms:
+            rms_img = rms[0][0:1,0:1,:,:][0,0]
+    else:
+        with fits.open(image_file, memmap=True) as image:
+            img = image[0].section[0,0,:,:]
+        with fits.open(rms_image, memmap=True) as rms:
+            rms_img = rms[0].section[0,0,:,:]
 
     fig = plt.figure(figsize=(20,20))
     ax = plt.subplot(projection=wcs)
@@ -241,9 +356,16 @@ def plot_sf_results(image_file, rms_image, regions, plot):
     ax.set_xlabel('RA')
     ax.set_ylabel('DEC')
 
-    for region in regions:
-        patch = region.to_pixel(wcs).as_artist(facecolor='none', edgecolor='m', lw=0.25)
-        ax.add_patch(patch)
+    # Draw all the sources as a single collection
+    pixel_regions = regions_to_pixel(regions, wcs)
+    ellipses = EllipseCollection(widths=[region.width for region in pixel_regions],
+                                 heights=[region.height for region in pixel_regions],
+                                 angles=[region.angle.to_value(u.deg) for region in pixel_regions],
+                                 units='xy',
+                                 offsets=[(region.center.x, region.center.y) for region in pixel_regions],
+                                 offset_transform=ax.transData,
+                                 facecolors='none', edgecolors='m', linewidths=0.25)
+    ax.add_collection(ellipses, autolim=False)
 
     if plot is True:
         plt.savefig(os.path.splitext(image_file)[0]+'.png', dpi=300, bbox_inches='tight')
@@ -264,9 +386,14 @@ def main():
     spectral_index = args.spectral_index
     survey = args.survey
 
-    if mode.lower() in 'cataloging':
+    # Accept any abbreviation of the mode, e.g. c, cat or cataloging
+    mode_lower = mode.lower()
+    cataloging = bool(mode_lower) and 'cataloging'.startswith(mode_lower)
+    masking = bool(mode_lower) and 'masking'.startswith(mode_lower)
+
+    if cataloging:
         bdsf_args = 'parsets/bdsf_args_cat.json'
-    elif mode.lower() in 'masking':
+    elif masking:
         bdsf_args = 'parsets/bdsf_args_mask.json'
     else:
         print(f'Invalid mode {mode}, please choose between c(ataloging) or m(asking)')
@@ -287,29 +414,46 @@ def main():
         print('No FITS catalog generated, no further operations are performed')
         sys.exit()
 
-    bdsf_cat = Table.read(outcat)
+    # Memory map the catalog PyBDSF just wrote, the image header stored
+    # in its comments is needed so it is not built from img.sources
+    bdsf_cat = Table.read(outcat, memmap=True)
     bdsf_regions = catalog_to_regions(bdsf_cat)
 
     if plot:
         plot_sf_results(f'{imname}_ch0.fits', f'{imname}_rms.fits', bdsf_regions, plot)
 
+    # Collect the new columns so the table is only rebuilt once,
+    # the indexes refer to the columns of the PyBDSF catalog
+    #
+    new_columns = []
+    indexes = []
     if spectral_index:
-        bdsf_cat = read_alpha(inpimage, bdsf_cat, bdsf_regions)
+        alpha_columns, alpha_indexes = read_alpha(inpimage, bdsf_regions)
+        new_columns += alpha_columns
+        indexes += alpha_indexes
+
+    if cataloging:
+        cat_columns, cat_indexes = transform_cat(bdsf_cat, survey, img, bdsf_args)
+        new_columns += cat_columns
+        indexes += cat_indexes
+
+    if new_columns:
+        bdsf_cat.add_columns(new_columns, indexes=indexes)
 
     # Determine output by mode
-    if mode.lower() in 'cataloging':
+    if cataloging:
         outcat = outcat.replace('srl_','')
-        bdsf_cat = transform_cat(bdsf_cat, survey, img, bdsf_args)
         print(f'Wrote catalog to {outcat}')
-        bdsf_cat.write(outcat, overwrite=True)
+        write_fits_catalog(bdsf_cat, outcat)
 
-    if mode.lower() in 'masking':
-        bdsf_cat.write(outcats[i], overwrite=True)
+    if masking:
+        write_fits_catalog(bdsf_cat, outcat)
         write_mask(outfile=imname+'_mask.crtf', regions=bdsf_regions, size=size)
 
     # Make sure the log file is in the output folder
     logname = inpimage+'.pybdsf.log'
-    os.system(f'mv {logname} {output_dir}')
+    if os.path.exists(logname):
+        shutil.move(logname, os.path.join(output_dir, os.path.basename(logname)))
 
 def new_argument_parser():
 